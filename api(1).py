@@ -1,12 +1,22 @@
 """分镜生成核心 API."""
+import asyncio
 import base64
 import json
 import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 from io import BytesIO
-from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile
+from fastapi import APIRouter, Depends, File, Form, Header, HTTPException, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.routing import APIRoute
 from PIL import Image
+from pydantic import BaseModel
 
 from app.config import HISTORY_DIR
 from app.prompt import SHOT_PROMPT
@@ -28,7 +38,23 @@ from app.services.lingke import (
 )
 
 logger = logging.getLogger(__name__)
-router = APIRouter(prefix="/api", tags=["storyboard"])
+
+
+class _UploadLimitRoute(APIRoute):
+    """multipart 请求在 FastAPI 解析表单（上传内容落盘）之前先按 Content-Length 拒绝超限请求。"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request):
+            if request.headers.get("content-type", "").startswith("multipart/form-data"):
+                _check_content_length(request, _MAX_UPLOAD_TOTAL_BYTES + _MAX_FORM_TEXT_BYTES)
+            return await handler(request)
+
+        return limited_handler
+
+
+router = APIRouter(prefix="/api", tags=["storyboard"], route_class=_UploadLimitRoute)
 
 
 # JPEG 压缩质量（分辨率不变，仅格式与压缩）
@@ -39,6 +65,16 @@ _THUMB_MAX_SIZE = 400
 _THUMB_MAX_SIZE_GRID = 320
 _THUMB_QUALITY = 80
 
+# 上传图片限制（可通过环境变量覆盖）：单文件字节数、像素数、单次请求文件数与总字节数
+_MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+_MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_PIXELS", str(40_000_000)))
+_MAX_UPLOAD_FILES = int(os.getenv("MAX_UPLOAD_FILES", "8"))
+_MAX_UPLOAD_TOTAL_BYTES = int(os.getenv("MAX_UPLOAD_TOTAL_BYTES", str(50 * 1024 * 1024)))
+# 表单中非文件字段（剧本、提示词等）预留的字节数，用于按 Content-Length 提前拒绝
+_MAX_FORM_TEXT_BYTES = 2 * 1024 * 1024
+# 分块编码大小，须为 3 的倍数，保证逐块 base64 拼接结果与整体编码一致
+_UPLOAD_CHUNK_SIZE = 3 * 64 * 1024
+
 
 def _pil_to_jpeg_data_url(pil_img: Image.Image, quality: int = _JPEG_QUALITY) -> str:
     """将 PIL 图转为 JPEG base64 data URL（分辨率不变）。RGBA/透明通道会先叠白底再转 RGB。"""
@@ -130,19 +166,103 @@ def _split_grid_image(base64_data: str) -> list[str]:
     return split_images
 
 
+def _upload_size(file: UploadFile) -> int:
+    """上传文件字节数：优先用 UploadFile.size，缺失时对其临时文件 seek 到末尾取得（不读内容）。"""
+    if file.size is not None:
+        return file.size
+    fp = file.file
+    pos = fp.tell()
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(pos)
+    return size
+
+
+def _check_content_length(request: Request, limit: int) -> None:
+    """按 Content-Length 在读取请求体之前拒绝超限请求；无 Content-Length（chunked）无法提前判断，一律拒绝。"""
+    content_length = request.headers.get("content-length")
+    if not content_length or not content_length.isdigit():
+        raise HTTPException(status_code=411, detail="上传请求须携带 Content-Length")
+    if int(content_length) > limit:
+        raise HTTPException(status_code=413, detail=f"请求体超过大小上限 {limit} 字节")
+
+
+def _upload_to_ref(file: UploadFile, mime: str) -> dict[str, str]:
+    """
+    同步：直接读取 Starlette 已落盘的上传临时文件，校验后编码为 ref_images 格式。
+    base64 逐块写入按最终长度预分配的 bytearray，原始字节不会整份读入内存；
+    最后 decode 为 str 时 bytearray 与 str 短暂并存，峰值约为原文件的 2.7 倍，返回后仅保留 str（约 1.33 倍）。
+    """
+    name = file.filename or ""
+    size = _upload_size(file)
+    if size > _MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"上传文件 {name} 超过大小上限 {_MAX_UPLOAD_BYTES} 字节",
+        )
+    if size == 0:
+        raise HTTPException(status_code=422, detail=f"上传文件 {name} 为空")
+
+    # Image.open 只解析文件头，不解码像素
+    fp = file.file
+    fp.seek(0)
+    try:
+        with Image.open(fp) as img:
+            width, height = img.size
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"上传图片 {name} 像素数超过上限")
+    except Exception:
+        raise HTTPException(status_code=422, detail=f"上传文件 {name} 不是有效图片")
+    if width * height > _MAX_UPLOAD_PIXELS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"上传图片 {name} 尺寸 {width}×{height} 超过像素上限 {_MAX_UPLOAD_PIXELS}",
+        )
+
+    fp.seek(0)
+    buf = bytearray(4 * ((size + 2) // 3))
+    pos = 0
+    while True:
+        chunk = fp.read(_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        encoded = base64.b64encode(chunk)
+        buf[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+    if pos != len(buf):
+        raise HTTPException(status_code=422, detail=f"上传文件 {name} 读取不完整")
+    logger.info("[upload] %s size=%s pixels=%sx%s", name, size, width, height)
+    return {"mime_type": mime, "data": buf.decode("ascii")}
+
+
 async def _file_to_ref_async(file: UploadFile) -> dict[str, str]:
-    """异步：将上传文件转为 ref_images 格式。"""
-    content = await file.read()
+    """异步：将上传文件转为 ref_images 格式（校验与编码在线程池中执行，不阻塞事件循环）。"""
     ext = (file.filename or "").lower().split(".")[-1] if file.filename else ""
     mime = {
         "jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
         "gif": "image/gif", "webp": "image/webp",
     }.get(ext, "image/jpeg")
-    return {"mime_type": mime, "data": base64.b64encode(content).decode("ascii")}
+    return await run_in_threadpool(_upload_to_ref, file, mime)
 
 
 _MAX_TASKS = 50
 
+# 同一 client_id 的历史读-改-写须串行（保存在线程池中执行，可能并发）；按 client_id 哈希分片，锁数量固定
+_CLIENT_LOCK_STRIPES = 64
+_client_locks = [threading.RLock() for _ in range(_CLIENT_LOCK_STRIPES)]
+
+
+def _client_lock(client_id: str) -> threading.RLock:
+    """取 client_id 对应的历史写锁（可重入：保存时读索引可能触发迁移）。"""
+    return _client_locks[hash(client_id) % _CLIENT_LOCK_STRIPES]
+
+
+def _write_json_atomic(path, data) -> None:
+    """先写临时文件再原子替换，避免并发读取（如检索索引构建）读到写了一半的 JSON。"""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
 # 方案 A：索引文件只存轻量数据；单任务完整数据存 history/{client_id}/{task_id}.json
 
 
@@ -159,12 +279,8 @@ def _task_light(task: dict) -> dict:
     }
 
 
-def _load_index(client_id: str) -> tuple[list[str], dict]:
-    """
-    只读索引文件，返回 (order, tasks_light)。
-    tasks_light 不含 grid_image、split_images，仅含 has_grid、has_splits 等轻量字段。
-    若发现旧格式（单文件含图片），则迁移为索引 + 按任务文件后返回新索引。
-    """
+def _read_index_raw(client_id: str) -> tuple[list[str], dict]:
+    """只解析索引文件，返回 (order, tasks_raw)，不做迁移；旧格式时 tasks_raw 含完整图片数据。"""
     index_file = HISTORY_DIR / f"{client_id}.json"
     if not index_file.exists():
         return [], {}
@@ -188,17 +304,34 @@ def _load_index(client_id: str) -> tuple[list[str], dict]:
             order.append(tid)
             tasks_raw[tid] = {**item, "task_id": tid}
 
-    if not tasks_raw:
-        return [], {}
+    return order, tasks_raw
+
 
-    # 判断是否为旧格式：任意任务含 grid_image 或 split_images 即视为旧格式，需迁移
-    is_legacy = any(
+def _is_legacy_tasks(tasks_raw: dict) -> bool:
+    """任意任务含 grid_image 或 split_images 即视为旧格式（单文件含图片）。"""
+    return any(
         "grid_image" in t or "split_images" in t
         for t in tasks_raw.values()
         if isinstance(t, dict)
     )
-    if is_legacy:
-        _migrate_to_per_task_storage(client_id, order, tasks_raw)
+
+
+def _load_index(client_id: str) -> tuple[list[str], dict]:
+    """
+    只读索引文件，返回 (order, tasks_light)。
+    tasks_light 不含 grid_image、split_images，仅含 has_grid、has_splits 等轻量字段。
+    若发现旧格式（单文件含图片），则迁移为索引 + 按任务文件后返回新索引。
+    """
+    order, tasks_raw = _read_index_raw(client_id)
+    if not tasks_raw:
+        return [], {}
+
+    # 旧格式需迁移（持锁后重读，避免与并发保存/迁移交错）
+    if _is_legacy_tasks(tasks_raw):
+        with _client_lock(client_id):
+            order, tasks_raw = _read_index_raw(client_id)
+            if _is_legacy_tasks(tasks_raw):
+                _migrate_to_per_task_storage(client_id, order, tasks_raw)
         return _load_index(client_id)
 
     # 已是新格式：tasks 应为轻量（仅有 has_grid/has_splits，无大图）
@@ -229,13 +362,11 @@ def _migrate_to_per_task_storage(client_id: str, order: list[str], tasks_raw: di
             "grid_image": t.get("grid_image"),
             "split_images": t.get("split_images") or [],
         }
-        task_file.write_text(json.dumps(full, ensure_ascii=False, indent=2), encoding="utf-8")
+        _write_json_atomic(task_file, full)
 
-    index_file.write_text(
-        json.dumps({"order": order, "tasks": tasks_light}, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    _write_json_atomic(index_file, {"order": order, "tasks": tasks_light})
     logger.info("[history] 已迁移为按任务分文件存储 client_id=%s tasks=%s", client_id, len(order))
+    _search_index_upsert(client_id, [{**tasks_raw[tid], "task_id": tid} for tid in tasks_light])
 
 
 def _load_task(client_id: str, task_id: str) -> dict | None:
@@ -249,6 +380,318 @@ def _load_task(client_id: str, task_id: str) -> dict | None:
         return None
 
 
+# 全局检索索引：跨 client_id 的任务元数据 + 剧本/分镜提示词全文，存于 HISTORY_DIR 下的 SQLite。
+# 由 _save_history_upsert / 迁移增量维护；全量构建在后台线程执行（admin_router 启动时或重建接口触发），按客户端分批短事务提交。
+_SEARCH_DB = HISTORY_DIR / "_search_index.db"
+# 增量更新失败的客户端在此目录下留一个同名标记文件，下次写入索引成功时补录
+_SEARCH_DIRTY_DIR = HISTORY_DIR / "_search_dirty"
+_SEARCH_PAGE_SIZE_MAX = 100
+# 索引结构版本：与库中 meta.built 不一致时视为未构建
+_SEARCH_SCHEMA_VERSION = "3"
+# 写入等待锁的秒数（全量构建按客户端分批提交，单次持锁很短）
+_SEARCH_WRITE_TIMEOUT = 10
+# 全量构建租约：超过该秒数未续约视为构建进程已退出，其它进程可接手
+_SEARCH_BUILD_LEASE = 300
+# 全量构建每提交一个客户端后让出写锁的最长秒数
+_SEARCH_BUILD_YIELD_MAX = 0.05
+_search_schema_ready = False
+# 单字索引中表示空白/字段边界的占位字符（私用区，不会出现在正常文本与检索词中）
+_SEARCH_BOUNDARY = "\ue000"
+
+# task_fts：trigram 分词，服务 ≥3 字符的子串检索；
+# task_fts_chars：正文逐字符分词（空白与字段边界记为占位字符，标点符号也保留为字符），
+# 1～2 字符检索按相邻字符短语匹配，不会跨空白或跨字段命中。
+_SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL DEFAULT '',
+    has_grid INTEGER NOT NULL DEFAULT 0,
+    has_splits INTEGER NOT NULL DEFAULT 0,
+    shot_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (client_id, task_id)
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks (updated_at DESC, id);
+CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_client_updated ON tasks (client_id, updated_at DESC);
+CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5(script, prompts, tokenize='trigram');
+DROP TABLE IF EXISTS task_fts_short;
+CREATE VIRTUAL TABLE IF NOT EXISTS task_fts_chars USING fts5(
+    body, tokenize="unicode61 remove_diacritics 0 categories 'L* N* M* P* S* Co'"
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+def _search_connect() -> sqlite3.Connection:
+    """打开检索索引库（自动提交模式，写事务由 _search_write_txn 显式管理）；进程内首次调用时建表。"""
+    global _search_schema_ready
+    HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(_SEARCH_DB, timeout=_SEARCH_WRITE_TIMEOUT, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _search_schema_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SEARCH_SCHEMA)
+        _search_schema_ready = True
+    return conn
+
+
+@contextmanager
+def _search_write_txn(conn: sqlite3.Connection):
+    """BEGIN IMMEDIATE 写事务：开始即取得写锁，保证事务内读到的历史文件与写入索引的先后一致。"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _search_index_built(conn: sqlite3.Connection) -> bool:
+    """索引是否已按当前结构版本全量构建过。"""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+    return row is not None and row["value"] == _SEARCH_SCHEMA_VERSION
+
+
+def _normalize_ts(value: str) -> str:
+    """将 ISO 8601 时间统一为 UTC、定长微秒格式，使字符串比较与时间先后一致；无法解析则原样返回。"""
+    if not value:
+        return ""
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return value
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _char_tokens(text: str) -> str:
+    """逐字符以空格分隔供 task_fts_chars 分词；连续空白记为一个边界占位字符。"""
+    tokens: list[str] = []
+    for ch in text:
+        if ch.isspace():
+            if tokens and tokens[-1] != _SEARCH_BOUNDARY:
+                tokens.append(_SEARCH_BOUNDARY)
+        else:
+            tokens.append(ch)
+    return " ".join(tokens)
+
+
+def _search_row(client_id: str, task: dict) -> dict:
+    """从任务（完整或轻量）提取检索字段：元数据 + 剧本与各分镜 prompt_text。"""
+    storyboard = task.get("storyboard") or {}
+    shots = storyboard.get("shots") if isinstance(storyboard, dict) else None
+    shots = shots if isinstance(shots, list) else []
+    prompts = [str(s.get("prompt_text") or "") for s in shots if isinstance(s, dict)]
+    return {
+        "client_id": client_id,
+        "task_id": task.get("task_id", ""),
+        "created_at": _normalize_ts(task.get("created_at", "")),
+        "updated_at": _normalize_ts(task.get("updated_at", "")),
+        "has_grid": int(bool(task.get("grid_image") or task.get("has_grid"))),
+        "has_splits": int(bool(task.get("split_images") or task.get("has_splits"))),
+        "shot_count": len(shots),
+        "script": task.get("script", "") or "",
+        "prompts": "\n".join(p for p in prompts if p),
+    }
+
+
+def _search_write(conn: sqlite3.Connection, row: dict) -> None:
+    """写入/覆盖一条任务的检索记录（tasks.id 与两张全文表的 rowid 一一对应）。"""
+    cur = conn.execute(
+        "SELECT id FROM tasks WHERE client_id = ? AND task_id = ?",
+        (row["client_id"], row["task_id"]),
+    ).fetchone()
+    if cur is None:
+        rowid = conn.execute(
+            "INSERT INTO tasks (client_id, task_id, created_at, updated_at, has_grid, has_splits, shot_count)"
+            " VALUES (:client_id, :task_id, :created_at, :updated_at, :has_grid, :has_splits, :shot_count)",
+            row,
+        ).lastrowid
+    else:
+        rowid = cur["id"]
+        conn.execute(
+            "UPDATE tasks SET created_at = :created_at, updated_at = :updated_at, has_grid = :has_grid,"
+            " has_splits = :has_splits, shot_count = :shot_count WHERE id = :id",
+            {**row, "id": rowid},
+        )
+        conn.execute("DELETE FROM task_fts WHERE rowid = ?", (rowid,))
+        conn.execute("DELETE FROM task_fts_chars WHERE rowid = ?", (rowid,))
+    conn.execute(
+        "INSERT INTO task_fts (rowid, script, prompts) VALUES (?, ?, ?)",
+        (rowid, row["script"], row["prompts"]),
+    )
+    # 剧本与分镜提示词之间以换行分隔，分词后即为边界，不会跨字段命中
+    conn.execute(
+        "INSERT INTO task_fts_chars (rowid, body) VALUES (?, ?)",
+        (rowid, _char_tokens(row["script"] + "\n" + row["prompts"])),
+    )
+
+
+def _search_delete_ids(conn: sqlite3.Connection, ids: list[int]) -> None:
+    """按 tasks.id 删除检索记录。"""
+    for rowid in ids:
+        conn.execute("DELETE FROM task_fts WHERE rowid = ?", (rowid,))
+        conn.execute("DELETE FROM task_fts_chars WHERE rowid = ?", (rowid,))
+        conn.execute("DELETE FROM tasks WHERE id = ?", (rowid,))
+
+
+def _search_delete(conn: sqlite3.Connection, client_id: str, task_ids: list[str]) -> None:
+    """删除若干任务的检索记录（如超出 _MAX_TASKS 被淘汰的任务）。"""
+    ids = []
+    for tid in task_ids:
+        cur = conn.execute(
+            "SELECT id FROM tasks WHERE client_id = ? AND task_id = ?", (client_id, tid)
+        ).fetchone()
+        if cur is not None:
+            ids.append(cur["id"])
+    _search_delete_ids(conn, ids)
+
+
+def _search_reindex_client(conn: sqlite3.Connection, client_id: str, *, renew_lease: bool = False) -> int:
+    """
+    在一个短写事务内按该客户端索引文件重建其检索记录，返回任务数。
+    只读索引文件中的轻量数据（不读含图片的单任务文件、不触发迁移）。
+    文件在持有写锁后读取：并发保存若先写文件，这里读到的即是新数据；若后写文件，其增量更新会在本事务之后覆盖。
+    """
+    with _search_write_txn(conn):
+        order, tasks_raw = _read_index_raw(client_id)
+        ids = [r["id"] for r in conn.execute("SELECT id FROM tasks WHERE client_id = ?", (client_id,))]
+        _search_delete_ids(conn, ids)
+        count = 0
+        for tid in order:
+            t = tasks_raw.get(tid)
+            if not isinstance(t, dict):
+                continue
+            _search_write(conn, _search_row(client_id, {**t, "task_id": tid}))
+            count += 1
+        if renew_lease:
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'building'", (str(time.time()),))
+    return count
+
+
+def _search_mark_dirty(client_id: str) -> None:
+    """记录增量更新失败的客户端，待下次写入索引成功时补录。"""
+    try:
+        _SEARCH_DIRTY_DIR.mkdir(parents=True, exist_ok=True)
+        (_SEARCH_DIRTY_DIR / client_id).touch()
+    except OSError as e:
+        logger.error("[history] 记录检索索引待补录客户端失败 client_id=%s: %s", client_id, e)
+
+
+def _search_flush_dirty(conn: sqlite3.Connection, before_ns: int | None = None) -> None:
+    """
+    补录标记为待补录的客户端；补录期间标记被再次更新（mtime 变化）则保留，留待下次。
+    before_ns 不为空时只处理该时刻之前的标记（全量构建开始前的标记已被构建覆盖）。
+    """
+    if not _SEARCH_DIRTY_DIR.is_dir():
+        return
+    for marker in _SEARCH_DIRTY_DIR.iterdir():
+        try:
+            mtime = marker.stat().st_mtime_ns
+        except FileNotFoundError:
+            continue
+        if before_ns is None or mtime >= before_ns:
+            _search_reindex_client(conn, marker.name)
+            logger.info("[history] 已补录检索索引 client_id=%s", marker.name)
+        try:
+            if marker.stat().st_mtime_ns == mtime:
+                marker.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _search_claim_build(conn: sqlite3.Connection, force: bool) -> bool:
+    """取得全量构建租约；已按当前版本构建（且非 force）或其它进程正在构建（租约未过期）时返回 False。"""
+    with _search_write_txn(conn):
+        if not force and _search_index_built(conn):
+            return False
+        row = conn.execute("SELECT value FROM meta WHERE key = 'building'").fetchone()
+        if row is not None and time.time() - float(row["value"]) < _SEARCH_BUILD_LEASE:
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('building', ?)", (str(time.time()),)
+        )
+    return True
+
+
+def sync_search_index(force: bool = False) -> int | None:
+    """
+    全量构建/对账检索索引（同步、耗时，须在后台线程中调用），返回任务数；无需构建或其它进程正在构建时返回 None。
+    按客户端分批短事务提交，期间增量更新只需等待单个客户端的事务；结束后删除已不存在的客户端并补录待补录客户端。
+    """
+    started_ns = time.time_ns()
+    conn = _search_connect()
+    try:
+        if not _search_claim_build(conn, force):
+            return None
+        try:
+            count = 0
+            seen: set[str] = set()
+            for index_file in HISTORY_DIR.glob("*.json"):
+                client_id = index_file.stem
+                seen.add(client_id)
+                t0 = time.monotonic()
+                count += _search_reindex_client(conn, client_id, renew_lease=True)
+                # SQLite 等锁是轮询重试：每批后让出与持锁等长的空档，避免并发保存长时间抢不到写锁
+                time.sleep(min(time.monotonic() - t0, _SEARCH_BUILD_YIELD_MAX))
+            stale = [
+                r["client_id"] for r in conn.execute("SELECT DISTINCT client_id FROM tasks")
+                if r["client_id"] not in seen
+            ]
+            for client_id in stale:
+                with _search_write_txn(conn):
+                    ids = [r["id"] for r in conn.execute("SELECT id FROM tasks WHERE client_id = ?", (client_id,))]
+                    _search_delete_ids(conn, ids)
+            with _search_write_txn(conn):
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", (_SEARCH_SCHEMA_VERSION,)
+                )
+                conn.execute("DELETE FROM meta WHERE key = 'building'")
+        except BaseException:
+            try:
+                conn.execute("DELETE FROM meta WHERE key = 'building'")
+            except sqlite3.Error:
+                pass
+            raise
+        _search_flush_dirty(conn, before_ns=started_ns)
+    finally:
+        conn.close()
+    logger.info("[history] 已全量构建检索索引 tasks=%s", count)
+    return count
+
+
+def _search_index_upsert(client_id: str, tasks: list[dict], removed: list[str] | None = None) -> None:
+    """增量更新检索索引；失败时记录为待补录客户端，不影响历史文件本身的写入。"""
+    try:
+        conn = _search_connect()
+    except Exception as e:
+        logger.warning("[history] 打开检索索引失败，已记录待补录 client_id=%s: %s", client_id, e)
+        _search_mark_dirty(client_id)
+        return
+    try:
+        try:
+            with _search_write_txn(conn):
+                if removed:
+                    _search_delete(conn, client_id, removed)
+                for t in tasks:
+                    _search_write(conn, _search_row(client_id, t))
+        except Exception as e:
+            logger.warning("[history] 更新检索索引失败，已记录待补录 client_id=%s: %s", client_id, e)
+            _search_mark_dirty(client_id)
+            return
+        try:
+            _search_flush_dirty(conn)
+        except Exception as e:
+            logger.warning("[history] 补录检索索引失败: %s", e)
+    finally:
+        conn.close()
+
+
 def _save_history_upsert(
     client_id: str,
     task_id: str,
@@ -260,76 +703,77 @@ def _save_history_upsert(
 ) -> None:
     """
     按 task_id 新增或更新：索引文件只存轻量；完整数据写入 history/{client_id}/{task_id}.json.
-    一个用户最多保留 _MAX_TASKS 个 task_id.
+    一个用户最多保留 _MAX_TASKS 个 task_id；同一 client_id 的读-改-写与检索索引更新在客户端锁内串行执行。
     """
-    order, tasks_light = _load_index(client_id)
-    now = datetime.utcnow().isoformat() + "Z"
-    index_file = HISTORY_DIR / f"{client_id}.json"
-    task_dir = HISTORY_DIR / client_id
-    task_dir.mkdir(parents=True, exist_ok=True)
-    task_file = task_dir / f"{task_id}.json"
-
-    if task_id in tasks_light:
-        light = tasks_light[task_id]
+    with _client_lock(client_id):
+        order, tasks_light = _load_index(client_id)
+        now = datetime.utcnow().isoformat() + "Z"
+        index_file = HISTORY_DIR / f"{client_id}.json"
+        task_dir = HISTORY_DIR / client_id
+        task_dir.mkdir(parents=True, exist_ok=True)
+        task_file = task_dir / f"{task_id}.json"
+        evicted: list[str] = []
+
+        if task_id in tasks_light:
+            light = tasks_light[task_id]
+            if script is not None:
+                light["script"] = script
+            if storyboard is not None:
+                light["storyboard"] = storyboard
+            if grid_image is not None:
+                light["has_grid"] = True
+            if split_images is not None:
+                light["has_splits"] = True
+            light["updated_at"] = now
+        else:
+            order.insert(0, task_id)
+            for _ in range(len(order) - _MAX_TASKS):
+                old_id = order.pop()
+                evicted.append(old_id)
+                tasks_light.pop(old_id, None)
+                old_path = task_dir / f"{old_id}.json"
+                if old_path.exists():
+                    try:
+                        old_path.unlink()
+                    except OSError:
+                        pass
+            tasks_light[task_id] = {
+                "task_id": task_id,
+                "created_at": now,
+                "updated_at": now,
+                "script": script or "",
+                "storyboard": storyboard or {},
+                "has_grid": bool(grid_image),
+                "has_splits": bool(split_images),
+            }
+
+        _write_json_atomic(index_file, {"order": order, "tasks": tasks_light})
+
+        # 单任务完整数据：优先从已有文件读再合并，避免覆盖掉未传入的字段
+        full: dict = {}
+        if task_file.exists():
+            try:
+                full = json.loads(task_file.read_text(encoding="utf-8"))
+            except Exception:
+                pass
+        full.setdefault("task_id", task_id)
+        full.setdefault("created_at", now)
+        full["updated_at"] = now
         if script is not None:
-            light["script"] = script
+            full["script"] = script
         if storyboard is not None:
-            light["storyboard"] = storyboard
+            full["storyboard"] = storyboard
         if grid_image is not None:
-            light["has_grid"] = True
+            full["grid_image"] = grid_image
         if split_images is not None:
-            light["has_splits"] = True
-        light["updated_at"] = now
-    else:
-        order.insert(0, task_id)
-        for _ in range(len(order) - _MAX_TASKS):
-            old_id = order.pop()
-            tasks_light.pop(old_id, None)
-            old_path = task_dir / f"{old_id}.json"
-            if old_path.exists():
-                try:
-                    old_path.unlink()
-                except OSError:
-                    pass
-        tasks_light[task_id] = {
-            "task_id": task_id,
-            "created_at": now,
-            "updated_at": now,
-            "script": script or "",
-            "storyboard": storyboard or {},
-            "has_grid": bool(grid_image),
-            "has_splits": bool(split_images),
-        }
-
-    index_file.write_text(
-        json.dumps({"order": order, "tasks": tasks_light}, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+            full["split_images"] = split_images
+        full.setdefault("script", "")
+        full.setdefault("storyboard", {})
+        full.setdefault("grid_image", None)
+        full.setdefault("split_images", [])
 
-    # 单任务完整数据：优先从已有文件读再合并，避免覆盖掉未传入的字段
-    full: dict = {}
-    if task_file.exists():
-        try:
-            full = json.loads(task_file.read_text(encoding="utf-8"))
-        except Exception:
-            pass
-    full.setdefault("task_id", task_id)
-    full.setdefault("created_at", now)
-    full["updated_at"] = now
-    if script is not None:
-        full["script"] = script
-    if storyboard is not None:
-        full["storyboard"] = storyboard
-    if grid_image is not None:
-        full["grid_image"] = grid_image
-    if split_images is not None:
-        full["split_images"] = split_images
-    full.setdefault("script", "")
-    full.setdefault("storyboard", {})
-    full.setdefault("grid_image", None)
-    full.setdefault("split_images", [])
-
-    task_file.write_text(json.dumps(full, ensure_ascii=False, indent=2), encoding="utf-8")
+        _write_json_atomic(task_file, full)
+        _search_index_upsert(client_id, [full], removed=evicted)
 
 
 @router.post(
@@ -376,6 +820,7 @@ async def generate_shots(request: Request) -> GenerateShotsResponse:
     **响应**：`storyboard` 为完整 JSON 对象（含 `shots`、`global_settings`、`reference_control_prompt` 等），步骤 2 需将 `storyboard` 序列化为 JSON 字符串传入。
     """
     try:
+        _check_content_length(request, _MAX_UPLOAD_BYTES + _MAX_FORM_TEXT_BYTES)
         form = await request.form()
         client_id = form.get("client_id")
         task_id = form.get("task_id")
@@ -442,7 +887,8 @@ async def generate_shots(request: Request) -> GenerateShotsResponse:
         
         # ========== 按 task_id 保存/更新历史（不冗余） ==========
         try:
-            _save_history_upsert(
+            await run_in_threadpool(
+                _save_history_upsert,
                 client_id,
                 task_id,
                 script=script,
@@ -510,7 +956,19 @@ async def generate_grid(
             )
         
         # 将上传文件转为 base64（后端内部使用）；不传则 ref_list 为空
-        ref_list = [await _file_to_ref_async(f) for f in (ref_images or []) if f and getattr(f, "filename", None)]
+        ref_files = [f for f in (ref_images or []) if f and getattr(f, "filename", None)]
+        if len(ref_files) > _MAX_UPLOAD_FILES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"参考图最多 {_MAX_UPLOAD_FILES} 张，当前上传了 {len(ref_files)} 张",
+            )
+        ref_total = sum(_upload_size(f) for f in ref_files)
+        if ref_total > _MAX_UPLOAD_TOTAL_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"参考图总大小 {ref_total} 字节超过上限 {_MAX_UPLOAD_TOTAL_BYTES} 字节",
+            )
+        ref_list = [await _file_to_ref_async(f) for f in ref_files]
         logger.info(f"[generate_grid] 使用 {len(ref_list)} 张参考图")
         
         # ========== 生成 5×5 宫格图 ==========
@@ -584,7 +1042,8 @@ async def generate_grid(
         # ========== 按 task_id 更新历史，保存完整图片数据 ==========
         created_at = datetime.utcnow().isoformat() + "Z"
         try:
-            _save_history_upsert(
+            await run_in_threadpool(
+                _save_history_upsert,
                 client_id,
                 task_id,
                 storyboard=storyboard_obj,
@@ -637,7 +1096,8 @@ def _task_summary(task_id: str, task: dict) -> TaskSummary:
 @router.get("/history/{client_id}", response_model=HistoryResponse)
 async def get_history(client_id: str) -> HistoryResponse:
     """获取客户端的历史记录（仅读索引，不含图片 base64）。需图片时调 /grid 或 /splits。"""
-    order, tasks_light = _load_index(client_id)
+    # 旧格式会在读取时迁移（含文件与检索索引写入），放到线程池执行
+    order, tasks_light = await run_in_threadpool(_load_index, client_id)
     history = [_task_summary(tid, tasks_light[tid]) for tid in order if tid in tasks_light]
     return HistoryResponse(client_id=client_id, history=history)
 
@@ -645,7 +1105,7 @@ async def get_history(client_id: str) -> HistoryResponse:
 @router.get("/history/{client_id}/meta", response_model=HistoryMetaResponse)
 async def get_history_meta(client_id: str) -> HistoryMetaResponse:
     """轻量新鲜度接口：仅返回各任务 updated_at，前端与本地缓存比较后决定是否拉取完整数据。"""
-    order, tasks_light = _load_index(client_id)
+    order, tasks_light = await run_in_threadpool(_load_index, client_id)
     tasks: dict[str, str] = {}
     latest = ""
     for tid in order:
@@ -693,3 +1153,203 @@ async def get_history_splits(client_id: str, task_id: str) -> HistorySplitsRespo
         split_images=split_images_thumb,
     )
     return HistorySplitsResponse(client_id=client_id, task=detail)
+
+
+# ========== 管理接口（运维/后台工具用，跨 client_id 可见，不挂在面向客户端的 /api 上） ==========
+# 由应用在内部入口单独 include；请求头 X-Admin-Token 须与环境变量 ADMIN_TOKEN 一致，未配置则一律拒绝。
+_ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def _require_admin(x_admin_token: str | None = Header(default=None)) -> None:
+    """校验管理令牌。"""
+    if not _ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理接口未启用（未配置 ADMIN_TOKEN）")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, _ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="管理令牌无效")
+
+
+_search_build_task: asyncio.Task | None = None
+
+
+def _sync_search_index_logged(force: bool) -> None:
+    """后台构建入口：异常只记日志（查询在构建完成前返回 503）。"""
+    try:
+        sync_search_index(force=force)
+    except Exception as e:
+        logger.error("[history] 构建检索索引失败: %s", e, exc_info=True)
+
+
+def _start_search_build(force: bool) -> bool:
+    """在后台线程启动全量构建，立即返回；本进程已有构建在进行时返回 False。"""
+    global _search_build_task
+    if _search_build_task is not None and not _search_build_task.done():
+        return False
+    _search_build_task = asyncio.create_task(run_in_threadpool(_sync_search_index_logged, force))
+    return True
+
+
+async def _search_index_startup() -> None:
+    """启动阶段：在后台构建检索索引（未按当前版本构建过时），不阻塞应用启动；多进程由构建租约保证只构建一次。"""
+    _start_search_build(force=False)
+
+
+admin_router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(_require_admin)],
+    on_startup=[_search_index_startup],
+)
+
+
+class HistorySearchItem(BaseModel):
+    """全局检索结果中的单条任务（仅元数据，不含剧本全文与图片）。"""
+
+    client_id: str
+    task_id: str
+    created_at: str = ""
+    updated_at: str = ""
+    has_grid: bool = False
+    has_splits: bool = False
+    shot_count: int = 0
+
+
+class HistorySearchResponse(BaseModel):
+    """全局检索分页结果。"""
+
+    total: int
+    page: int
+    page_size: int
+    items: list[HistorySearchItem]
+
+
+class SearchIndexRebuildResponse(BaseModel):
+    """检索索引全量重建请求结果。"""
+
+    started: bool
+
+
+def _parse_time_bound(name: str, value: str | None, upper: bool) -> tuple[str, str] | None:
+    """
+    解析检索时间边界，返回 (比较运算符, 规范化时间)；未传返回 None。
+    仅日期的上界按次日 0 点开区间处理，使 created_to=2024-01-01 包含当天全部任务。
+    """
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} 不是有效的 ISO 8601 时间: {value}")
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    try:
+        date.fromisoformat(value)
+        date_only = True
+    except ValueError:
+        date_only = False
+    if upper and date_only:
+        return "<", (dt + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return ("<=" if upper else ">="), dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _fts_phrase(text: str) -> str:
+    """转义为 FTS5 短语查询。"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _search_query(where: list[str], params: list, join: str, page: int, page_size: int) -> HistorySearchResponse:
+    """同步执行检索（在线程池中调用）。"""
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    conn = _search_connect()
+    try:
+        if not _search_index_built(conn):
+            raise HTTPException(status_code=503, detail="检索索引尚未构建完成，请稍后重试")
+        total = conn.execute(f"SELECT COUNT(*) FROM tasks t {join} {where_sql}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT t.client_id, t.task_id, t.created_at, t.updated_at, t.has_grid, t.has_splits, t.shot_count"
+            f" FROM tasks t {join} {where_sql} ORDER BY t.updated_at DESC, t.id DESC LIMIT ? OFFSET ?",
+            [*params, page_size, (page - 1) * page_size],
+        ).fetchall()
+    finally:
+        conn.close()
+
+    items = [
+        HistorySearchItem(
+            client_id=r["client_id"],
+            task_id=r["task_id"],
+            created_at=r["created_at"],
+            updated_at=r["updated_at"],
+            has_grid=bool(r["has_grid"]),
+            has_splits=bool(r["has_splits"]),
+            shot_count=r["shot_count"],
+        )
+        for r in rows
+    ]
+    return HistorySearchResponse(total=total, page=page, page_size=page_size, items=items)
+
+
+@admin_router.get("/history/search", response_model=HistorySearchResponse)
+async def search_history(
+    q: str | None = Query(default=None, description="全文检索：匹配剧本或任一分镜 prompt_text（子串匹配，至少 1 个字符）"),
+    client_id: str | None = Query(default=None, description="只查该客户端"),
+    created_from: str | None = Query(default=None, description="created_at 下界（含），ISO 8601 日期或时间"),
+    created_to: str | None = Query(default=None, description="created_at 上界（含），仅日期时包含当天"),
+    updated_from: str | None = Query(default=None, description="updated_at 下界（含）"),
+    updated_to: str | None = Query(default=None, description="updated_at 上界（含），仅日期时包含当天"),
+    has_grid: bool | None = Query(default=None, description="是否已有宫格图"),
+    has_splits: bool | None = Query(default=None, description="是否已有分割图"),
+    min_shots: int | None = Query(default=None, ge=0, description="分镜数下限"),
+    max_shots: int | None = Query(default=None, ge=0, description="分镜数上限"),
+    page: int = Query(default=1, ge=1),
+    page_size: int = Query(default=20, ge=1, le=_SEARCH_PAGE_SIZE_MAX),
+) -> HistorySearchResponse:
+    """跨所有 client_id 检索任务（走全局检索索引，不扫描历史目录），按 updated_at 倒序分页返回。"""
+    where: list[str] = []
+    params: list = []
+    join = ""
+    q = (q or "").strip()
+    if q:
+        if len(q) >= 3:
+            # trigram 分词：整体作为短语即为子串匹配
+            join = "JOIN task_fts f ON f.rowid = t.id"
+            where.append("task_fts MATCH ?")
+            params.append(_fts_phrase(q))
+        else:
+            # 1～2 个字符 trigram 无法命中，走逐字符索引：相邻字符短语即为子串匹配
+            join = "JOIN task_fts_chars f ON f.rowid = t.id"
+            where.append("task_fts_chars MATCH ?")
+            params.append(_fts_phrase(_char_tokens(q)))
+    if client_id and client_id.strip():
+        where.append("t.client_id = ?")
+        params.append(client_id.strip())
+    for name, column, value, upper in (
+        ("created_from", "t.created_at", created_from, False),
+        ("created_to", "t.created_at", created_to, True),
+        ("updated_from", "t.updated_at", updated_from, False),
+        ("updated_to", "t.updated_at", updated_to, True),
+    ):
+        bound = _parse_time_bound(name, value, upper)
+        if bound is not None:
+            op, ts = bound
+            where.append(f"{column} <> '' AND {column} {op} ?")
+            params.append(ts)
+    for column, op, value in (
+        ("t.has_grid", "=", None if has_grid is None else int(has_grid)),
+        ("t.has_splits", "=", None if has_splits is None else int(has_splits)),
+        ("t.shot_count", ">=", min_shots),
+        ("t.shot_count", "<=", max_shots),
+    ):
+        if value is not None:
+            where.append(f"{column} {op} ?")
+            params.append(value)
+    return await run_in_threadpool(_search_query, where, params, join, page, page_size)
+
+
+@admin_router.post(
+    "/history/search-index/rebuild",
+    response_model=SearchIndexRebuildResponse,
+    status_code=202,
+)
+async def rebuild_search_index() -> SearchIndexRebuildResponse:
+    """在后台从历史索引文件全量重建检索索引（对账），立即返回；重建按客户端分批提交，期间查询与保存不受阻塞。"""
+    return SearchIndexRebuildResponse(started=_start_search_build(force=True))